@@ -10,8 +10,10 @@ Email: brcrabb@eng.ucsd.edu
 # import statements
 import tkinter as tk
 from tkinter import filedialog as fd
-from PIL import ImageTk, Image, ImageOps
+from PIL import ImageTk, Image, ImageOps, ImageDraw
 import os
+import queue
+import threading
 import pydicom
 import pandas as pd
 import cv2
@@ -23,6 +25,7 @@ class MainApplication(tk.Frame):
     def __init__(self, parent, *args, **kwargs):
         tk.Frame.__init__(self, parent, *args, **kwargs)
         self.parent = parent
+        self.triage_window = None
 
         # start application by selecting files
         self.select_files()
@@ -34,6 +37,7 @@ class MainApplication(tk.Frame):
         """
 
         # clear old grid objects
+        self.close_triage()
 
         self.path = fd.askdirectory(title='Select Patient Directory',
                                initialdir='./')
@@ -202,6 +206,9 @@ class MainApplication(tk.Frame):
         :return:
         """
 
+        # the mosaic overlays are built from the old predictions
+        self.close_triage()
+
         self.preds_path = fd.askopenfilename(title='Select Predictions File',
                                         initialdir='./')
 
@@ -528,6 +535,8 @@ class MainApplication(tk.Frame):
                 self.current_view_label[fname] = key.upper()
             print('Adding new labels..')
 
+        self.refresh_tiles()
+
         self.autosave_counter += 1
         if self.autosave_counter % 10 == 0:
             self.save_output()
@@ -592,6 +601,306 @@ class MainApplication(tk.Frame):
 
         self.main()
 
+    def open_triage(self):
+
+        """
+        Opens the triage window, a mosaic of every series in the patient directory. Thumbnails are
+        built in the background from the middle frame of each series and overlaid with the predicted
+        view and confidence.
+        :return: none.
+        """
+
+        self.close_triage()
+
+        self.triage_window = tk.Toplevel(self.parent)
+        self.triage_window.title('CAP Automation Triage: {}'.format(self.patient_name))
+        self.triage_window.protocol('WM_DELETE_WINDOW', self.close_triage)
+
+        # series index -> (series id, list of dicom files) and the mosaic tiles
+        self.triage_series = {}
+        self.triage_tiles = {}
+        self.triage_images = {}
+
+        # thumbnails are decoded in a worker thread and handed to the GUI thread through a queue
+        self.triage_queue = queue.Queue()
+        self.triage_stop = threading.Event()
+        self.triage_thread = threading.Thread(target=self.build_thumbnails,
+                                              args=(list(self.series_list), dict(self.pred_view_labels),
+                                                    dict(self.confidence), self.triage_queue, self.triage_stop),
+                                              daemon=True)
+
+        # controls
+        self.threshold_var = tk.DoubleVar()
+        self.threshold_var.set(0.95)
+        self.threshold_scale = tk.Scale(self.triage_window, variable=self.threshold_var, from_=0.0, to=1.0,
+                                        resolution=0.01, orient=tk.HORIZONTAL, label='Confidence Threshold',
+                                        length=200, command=lambda value: self.refresh_tiles())
+        self.button_accept_all = tk.Button(self.triage_window, text='Accept All Above Threshold',
+                                           command=self.accept_confident, state=tk.DISABLED)
+        self.button_review = tk.Button(self.triage_window, text='Review Next Low Confidence',
+                                       command=self.review_next)
+
+        self.triage_var = tk.StringVar()
+        self.triage_var.set('Loading series: 0/{}'.format(len(self.series_list)))
+        self.triage_status = tk.Label(self.triage_window, textvariable=self.triage_var, anchor='w', justify=tk.LEFT)
+
+        # mosaic in a scrollable canvas, full studies are taller than the screen
+        self.triage_canvas = tk.Canvas(self.triage_window, width=8 * 138, height=4 * 138, highlightthickness=0)
+        self.triage_scroll = tk.Scrollbar(self.triage_window, orient=tk.VERTICAL, command=self.triage_canvas.yview)
+        self.triage_canvas.configure(yscrollcommand=self.triage_scroll.set)
+        self.triage_frame = tk.Frame(self.triage_canvas)
+        self.triage_canvas.create_window((0, 0), window=self.triage_frame, anchor='nw')
+        self.triage_frame.bind('<Configure>', lambda event: self.triage_canvas.configure(
+            scrollregion=self.triage_canvas.bbox('all')))
+        self.triage_window.bind('<MouseWheel>', lambda event: self.triage_canvas.yview_scroll(
+            int(-event.delta / 120), 'units'))
+        self.triage_window.bind('<Button-4>', lambda event: self.triage_canvas.yview_scroll(-1, 'units'))
+        self.triage_window.bind('<Button-5>', lambda event: self.triage_canvas.yview_scroll(1, 'units'))
+
+        # positions
+        self.threshold_scale.grid(row=0, column=0, sticky='w')
+        self.button_accept_all.grid(row=0, column=1, sticky='w', padx=12)
+        self.button_review.grid(row=0, column=2, sticky='w')
+        self.triage_status.grid(row=1, column=0, columnspan=3, sticky='w')
+        self.triage_canvas.grid(row=2, column=0, columnspan=3, sticky='nsew')
+        self.triage_scroll.grid(row=2, column=3, sticky='ns')
+        self.triage_window.grid_rowconfigure(2, weight=1)
+        self.triage_window.grid_columnconfigure(2, weight=1)
+
+        self.triage_thread.start()
+        self.triage_poll_id = self.parent.after(100, self.poll_thumbnails)
+
+    def close_triage(self):
+
+        """
+        Stops the thumbnail worker and closes the triage window, if open.
+        :return: none.
+        """
+
+        if self.triage_window is None:
+            return
+
+        self.triage_stop.set()
+        if self.triage_poll_id is not None:
+            self.parent.after_cancel(self.triage_poll_id)
+            self.triage_poll_id = None
+
+        self.triage_window.destroy()
+        self.triage_window = None
+
+    def make_thumbnail(self, dcm, size=128):
+
+        """
+        Windows and downsamples a single frame for the triage mosaic. Works on local copies only so it
+        is safe to call from the thumbnail worker thread.
+        :param dcm: (pydicom Dataset) the frame to display.
+        :param size: (int) side length of the square thumbnail.
+        :return: thumb (PIL Image) - windowed, resized and padded thumbnail.
+        """
+
+        # windowing
+        window_center = float(dcm[0x0028, 0x1050].value)
+        window_width = float(dcm[0x0028, 0x1051].value)
+        img = dcm.pixel_array.astype(np.float32)
+        img = np.clip(img, window_center - window_width // 2, window_center + window_width // 2)
+
+        # normalize
+        img = img / max(np.max(img), 1) * 255
+
+        # downsample so max size is the thumbnail size, cv2 expects (width, height)
+        ratio = size / np.max(img.shape)
+        new_size = (max(int(img.shape[1] * ratio), 1), max(int(img.shape[0] * ratio), 1))
+        thumb = Image.fromarray(cv2.resize(img, new_size, interpolation=cv2.INTER_AREA).astype(np.uint8))
+
+        # pad to square
+        delta_w = size - new_size[0]
+        delta_h = size - new_size[1]
+        padding = (delta_w // 2, delta_h // 2, delta_w - (delta_w // 2), delta_h - (delta_h // 2))
+
+        return ImageOps.expand(thumb, padding)
+
+    def build_thumbnails(self, series_list, pred_view_labels, confidence, thumb_queue, stop_event):
+
+        """
+        Worker thread: reads the middle frame of each series and queues its thumbnail for the mosaic.
+        Only one frame per series is decoded. Tk objects are never touched here.
+        :param series_list: (list) paths to the series directories.
+        :param pred_view_labels: (dict) snapshot of the predicted view for each series id.
+        :param confidence: (dict) snapshot of the prediction confidence for each series id.
+        :param thumb_queue: (queue.Queue) receives (index, series id, files, thumbnail), then None when done.
+        :param stop_event: (threading.Event) set when the triage window is closed.
+        :return: none.
+        """
+
+        try:
+            for index, series in enumerate(series_list):
+                if stop_event.is_set():
+                    return
+
+                # skip stray files in the patient directory
+                if not os.path.isdir(series):
+                    continue
+
+                try:
+                    files = sorted([file for file in os.listdir(series) if '.dcm' in file])
+                    if len(files) == 0:
+                        continue
+
+                    dcm = pydicom.dcmread(os.path.join(series, files[len(files) // 2]), force=True)
+                    thumb = self.make_thumbnail(dcm)
+                    series_id = dcm.SeriesInstanceUID
+                except Exception as e:
+                    print('Could not build thumbnail for {}: {}'.format(series, e))
+                    continue
+
+                # overlay predicted view and confidence
+                if series_id in pred_view_labels.keys():
+                    text = '{} ({})'.format(pred_view_labels[series_id], confidence.get(series_id))
+                else:
+                    text = 'None'
+                draw = ImageDraw.Draw(thumb)
+                draw.rectangle((0, 0, thumb.size[0], 12), fill=0)
+                draw.text((2, 0), text, fill=255)
+
+                thumb_queue.put((index, series_id, files, thumb))
+        finally:
+            # always signal the GUI thread so the mosaic never waits forever
+            thumb_queue.put(None)
+
+    def poll_thumbnails(self):
+
+        """
+        Adds any thumbnails finished by the worker thread to the mosaic.
+        :return: none.
+        """
+
+        columns = 8
+        done = False
+        try:
+            while True:
+                item = self.triage_queue.get_nowait()
+                if item is None:
+                    done = True
+                    break
+
+                index, series_id, files, thumb = item
+                self.triage_series[index] = (series_id, files)
+                self.triage_images[index] = ImageTk.PhotoImage(thumb, master=self.triage_window)
+
+                tile = tk.Label(self.triage_frame, image=self.triage_images[index], bd=4, cursor='hand2')
+                tile.bind('<Button-1>', lambda event, i=index: self.review_series(i))
+                tile.grid(row=index // columns, column=index % columns, padx=1, pady=1)
+                self.triage_tiles[index] = tile
+                self.update_tile(index)
+        except queue.Empty:
+            pass
+
+        if done:
+            self.triage_var.set('Loaded {}/{} series'.format(len(self.triage_series), len(self.series_list)))
+            self.button_accept_all.configure(state=tk.NORMAL)
+            self.triage_poll_id = None
+        else:
+            self.triage_var.set('Loading series: {}/{}'.format(len(self.triage_series), len(self.series_list)))
+            self.triage_poll_id = self.parent.after(100, self.poll_thumbnails)
+
+    def is_confident(self, series_id):
+
+        """
+        Checks whether a series has a prediction at or above the triage confidence threshold.
+        :param series_id: (str) the series instance uid.
+        :return: (bool)
+        """
+
+        if series_id not in self.pred_view_labels.keys():
+            return False
+        return self.confidence[series_id] >= self.threshold_var.get()
+
+    def update_tile(self, index):
+
+        """
+        Colors a mosaic tile border: green if labelled, blue if above threshold, red otherwise.
+        :param index: (int) the series index.
+        :return: none.
+        """
+
+        series_id, files = self.triage_series[index]
+        if files[0] in self.current_view_label.keys():
+            color = 'green'
+        elif self.is_confident(series_id):
+            color = 'blue'
+        else:
+            color = 'red'
+        self.triage_tiles[index].configure(bg=color)
+
+    def refresh_tiles(self):
+
+        """
+        Recolors every mosaic tile, e.g. after the threshold or labels change.
+        :return: none.
+        """
+
+        if self.triage_window is None:
+            return
+
+        for index in self.triage_tiles.keys():
+            self.update_tile(index)
+
+    def accept_confident(self):
+
+        """
+        Accepts the predicted view of every unlabelled series at or above the confidence threshold
+        and saves the labels. Series that already have a label are left untouched.
+        :return: none.
+        """
+
+        accepted = 0
+        for index, (series_id, files) in self.triage_series.items():
+            if files[0] in self.current_view_label.keys() or not self.is_confident(series_id):
+                continue
+            for fname in files:
+                self.current_view_label[fname] = self.pred_view_labels[series_id].upper()
+            accepted += 1
+
+        print('Accepted {} predictions at or above {}'.format(accepted, self.threshold_var.get()))
+        self.save_output()
+        self.refresh_tiles()
+
+        if self.file_list[0] in self.current_view_label.keys():
+            self.cur_view.set('Accepted View Label: {}       '.format(self.current_view_label[self.file_list[0]].upper()))
+
+    def review_series(self, index):
+
+        """
+        Opens a series in the main cine view.
+        :param index: (int) the series index.
+        :return: none.
+        """
+
+        if self.cancel_id is not None:
+            self.parent.after_cancel(self.cancel_id)
+            self.cancel_id = None
+
+        # forward() loads the series after the current one
+        self.series_number = index - 1
+        self.forward()
+
+    def review_next(self):
+
+        """
+        Opens the next unlabelled series below the confidence threshold in the main cine view.
+        :return: none.
+        """
+
+        indices = sorted(self.triage_series.keys())
+        indices = [i for i in indices if i > self.series_number] + [i for i in indices if i <= self.series_number]
+        for index in indices:
+            series_id, files = self.triage_series[index]
+            if files[0] not in self.current_view_label.keys() and not self.is_confident(series_id):
+                self.review_series(index)
+                return
+
+        print('No low confidence series left to review')
+
     def main(self):
 
         """
@@ -632,6 +941,7 @@ class MainApplication(tk.Frame):
         self.disable = tk.Button(self.parent, text="stop", command=lambda: self.cancel_animation)
         self.open_button = tk.Button(self.parent, text='Select Directory', command=self.select_files)
         self.preds_button = tk.Button(self.parent, text='Select Predictions File', command=self.select_predictions)
+        self.triage_button = tk.Button(self.parent, text='Triage Mode', command=self.open_triage)
 
         # button positions
         self.button_back.grid(row=17, column=4)
@@ -647,6 +957,7 @@ class MainApplication(tk.Frame):
         self.button_other.grid(row=8, column=10)
         self.button_accept.grid(row=17, column=0, sticky='w')
         self.button_save.grid(row=1, column=2, sticky='w', padx=12)
+        self.triage_button.grid(row=17, column=1, sticky='w')
         self.enable.grid(row=4, column=3)
         self.disable.grid(row=5, column=3)
 